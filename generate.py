@@ -1,13 +1,56 @@
 #!/usr/bin/env python3
 
 import sys
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import itertools
 import yaml
 import re
 import os
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+# Use the libyaml parser when PyYAML was built with it. Like BaseLoader,
+# CBaseLoader keeps every scalar as a string.
+try:
+    from yaml import CBaseLoader as YamlLoader
+except ImportError:
+    from yaml import BaseLoader as YamlLoader
 
 FileName = str
 
+
+class Option(NamedTuple):
+    """Option read from yaml/defaults.yaml."""
+
+    NAME: str
+    DEFAULT: str
+    TYPE: str
+    DECL: str
+    BRIEF: str
+    DESCRIPTION: Optional[str]
+    H: Optional[str]
+    C: Optional[str]
+    TEST_ASSIGN: Optional[str]
+
+
+# Minimum number of option x char ID pairs to give each worker process.
+# Below that, starting the process costs more than generating the files.
+parallel_options_per_worker = 10000
+
+# Parsed YAML files by path, modification time and size, most recent last
+yaml_cache = collections.OrderedDict()
+yaml_cache_size = 100
+
+# Entries kept by each cached formatting function. Bounded so that a long
+# running process that generates many configurations does not keep growing.
+format_cache_size = 4096
+
+# Hash of the inputs of the last generation, followed by its output files
+stamp_file = ".toggle_stamp"
+
 decl_dict = {
     "BOOL": "bool @NAME@",
     "CHAR": "char @NAME@",
@@ -35,6 +78,33 @@ test_assign_dict = {
 """,
 }
 
+# Code of the MACRO_*, CONST_* and VAR_* declarations by base, whether the
+# option is being changed for testing, and format
+base_code_dict = {
+    # When testing and not a value, a macro is transformed in a non-const
+    # variable
+    ("MACRO", True, "decl"): "extern {decl};",
+    ("MACRO", True, "def"): "{decl} = @VALUE@;",
+    ("MACRO", True, "assign"): "{test_assign}",
+    ("MACRO", False, "decl"): "#define @NAME@ @VALUE@",
+    ("MACRO", False, "def"): "",
+    ("MACRO", False, "assign"): "",
+    # When testing and not a value, a const is transformed in a non-const
+    # variable
+    ("CONST", True, "decl"): "extern @CONST@ {decl};",
+    ("CONST", True, "def"): "@CONST@ {decl} = @VALUE@;",
+    ("CONST", True, "assign"): "{test_assign}",
+    ("CONST", False, "decl"): "extern @CONST@ {decl};",
+    ("CONST", False, "def"): "@CONST@ {decl} = @VALUE@;",
+    ("CONST", False, "assign"): "",
+    ("VAR", True, "decl"): "extern {decl};",
+    ("VAR", True, "def"): "{decl} = @VALUE@;",
+    ("VAR", True, "assign"): "{test_assign}",
+    ("VAR", False, "decl"): "extern {decl};",
+    ("VAR", False, "def"): "{decl} = @VALUE@;",
+    ("VAR", False, "assign"): "{test_assign}",
+}
+
 testing_reset_toggles_decl = f"""\
 /** @brief Reset toggles to the initialization values.
  *
@@ -47,6 +117,77 @@ testing_reset_toggles_decl = f"""\
 void testing_reset_toggles(void);
 """
 
+# Fixed parts of include/toggle.h and src/toggle.c
+toggle_h_begin = """\
+#ifndef TOGGLE_H
+#define TOGGLE_H
+
+#ifdef __cplusplus
+extern "C"
+{
+#endif
+
+/** @file toggle.h
+ * @brief Toggle definitions.
+ *
+ * This file validates the macro CHAR_ID and includes the corresponding
+ * Toggle header.
+ *
+ * In the list of CHAR_IDS, always add to the end of the list and
+ * increment NUM_CHAR_IDS.
+ *
+ * Numbering starts with 1 because the compiler would treat an undefined
+ * CHAR_ID as 0.
+ */
+
+#include <stdbool.h>
+#include <stdint.h>
+
+#ifdef DOXYGEN
+    /** @brief Characterization ID (int).
+     *
+     * Define the device characterization: the options and features enabled.
+     *
+     * The characterization ID should be defined when calling CMake (ex:
+     * `cmake -D CHAR_ID=...`) or when calling the compiler (ex:
+     * `gcc -D CHAR_ID=...`).
+     */
+    #define CHAR_ID CHAR_ID_TEST
+#endif
+
+#ifndef CHAR_ID
+    #define CHAR_ID CHAR_ID_TEST
+    #warning "CHAR_ID is not defined. Using default."
+#endif
+
+"""
+
+toggle_h_end = """\
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* TOGGLE_H */
+"""
+
+toggle_c_begin = """\
+#include "toggle.h"
+
+"""
+
+# Clean the generated code with the regular expressions of clean_code_regex()
+# instead of the line scan of clean_code(). Both give the same result.
+clean_code_with_regex = False
+
+# Regular expressions used by clean_code_regex()
+re_trailing_whitespace = re.compile(r"[ \t]+$", flags=re.MULTILINE)
+re_blank_before_brace = re.compile(r"\n\n+}")
+re_blank_after_brace = re.compile(r"{\n\n+")
+re_multiple_new_lines = re.compile(r"\n\n\n+")
+
+# Regular expression used by write_char_id_source()
+re_top_c = re.compile(r"TOP_C: (.*?)(?:\s*\*\/)?$", flags=re.MULTILINE)
+
 
 def printerr(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
@@ -56,19 +197,58 @@ def is_empty(s):
     return s is None
 
 
-def read_yaml_file(yaml_input: FileName) -> Tuple[List[str], List[str]]:
-    """Read from YAML file, return tuple with header and data."""
-    with open(yaml_input) as yaml_file:
-        data = yaml.load(
-            yaml_file,
-            Loader=yaml.BaseLoader,  # SafeLoader
-        )
+def read_yaml_file(yaml_input: FileName) -> List[Dict[str, str]]:
+    """Read from YAML file, return the list of entries."""
+    # Reuse the data parsed before if the file did not change. The readers
+    # modify the data, so the cache keeps its own copy.
+    stat = os.stat(yaml_input)
+    key = (os.path.abspath(yaml_input), stat.st_mtime_ns, stat.st_size)
+    if key in yaml_cache:
+        yaml_cache.move_to_end(key)
+        return copy.deepcopy(yaml_cache[key])
+
+    # Read the whole file at once, the reader would fetch it in small chunks
+    with open(yaml_input, encoding="utf-8") as yaml_file:
+        text = yaml_file.read()
+    data = yaml.load(
+        text,
+        Loader=YamlLoader,  # SafeLoader
+    )
+    # A top-level sequence is already a list, do not copy it
     if data is None:
-        return []
-    return list(data)
+        data = []
+    elif not isinstance(data, list):
+        data = list(data)
+
+    yaml_cache[key] = copy.deepcopy(data)
+    if len(yaml_cache) > yaml_cache_size:
+        yaml_cache.popitem(last=False)
 
+    return data
+
+
+def validate_fields(
+    x: Dict[str, str],
+    necessary: Set[str],
+    optional: Set[str],
+    all_known: Set[str],
+):
+    """Assert necessary fields, add missing optional ones, warn unknown ones."""
+    # Assert necessary fields are present
+    missing = necessary - x.keys()
+    assert not missing, f"Fields {sorted(missing)} are missing on data {x}"
 
-def read_defaults(yaml_input: FileName) -> Dict[str, Dict[str, str]]:
+    # Add missing optional fields
+    x.update(dict.fromkeys(optional - x.keys()))
+
+    # Warn any unknown fields, in the order they appear
+    if not x.keys() <= all_known:
+        for y in x:
+            if y not in all_known:
+                printerr(f"Warning: unknown field '{y}' in data {x}")
+
+
+def read_defaults(yaml_input: FileName) -> Dict[str, Option]:
     """Read default values from YAML file, return dict with name and data."""
 
     # Read from YAML file
@@ -81,36 +261,33 @@ def read_defaults(yaml_input: FileName) -> Dict[str, Dict[str, str]]:
     # Insert data in the dict
     defaults = {}
     for x in data:
-        # Assert necessary fields are present
-        for field in necessary:
-            assert field in x, f"Field '{field}' is missing on data {x}"
-
-        # Add missing optional fields
-        for field in optional:
-            if field not in x:
-                x[field] = None
+        validate_fields(x, necessary, optional, all_known)
 
-        # Warn any unknown fields
-        for y in x:
-            if y not in all_known:
-                printerr(f"Warning: unknown field '{y}' in data {x}")
+        # Intern TYPE and DECL: few distinct values, compared to literals
+        for field in ("TYPE", "DECL"):
+            if isinstance(x[field], str):
+                x[field] = sys.intern(x[field])
 
         # Assert option is not repeated
         name = x["NAME"]
-        assert name not in defaults, f"Option '{name}' is duplicated on {x}"
-        defaults[name] = x
+        option = Option(**{field: x[field] for field in Option._fields})
+        previous = defaults.setdefault(name, option)
+        assert previous is option, f"Option '{name}' is duplicated on {x}"
 
     return defaults
 
 
 def read_char_ids(
     yaml_input: FileName,
-    defaults: Dict[str, Dict[str, str]] = {},
+    defaults: Optional[Dict[str, Option]] = None,
 ) -> Dict[str, Dict[str, str]]:
     """
     Read characterizations from YAML file, return dict with char_id and data.
     """
 
+    if defaults is None:
+        defaults = {}
+
     # Read from YAML file
     data = read_yaml_file(yaml_input)
 
@@ -121,19 +298,7 @@ def read_char_ids(
     # Insert data in the dict
     char_ids = {}
     for x in data:
-        # Assert necessary fields are present
-        for field in necessary:
-            assert field in x, f"Field '{field}' is missing on data {x}"
-
-        # Add missing optional fields
-        for field in optional:
-            if field not in x:
-                x[field] = None
-
-        # Warn any unknown fields
-        for y in x:
-            if y not in all_known:
-                printerr(f"Warning: unknown field '{y}' in data {x}")
+        validate_fields(x, necessary, optional, all_known)
 
         # Assert char ID is not repeated
         name = x["CHAR_ID"]
@@ -163,105 +328,63 @@ def read_char_ids(
                 xx.update(char_ids[base])
             xx.update(x)
 
+        # Assert no VALUE option is redefined, once per char ID instead of
+        # on every declaration/definition generated for it
+        for option, option_data in defaults.items():
+            error_if_value_option_is_set_on_characterization_file(
+                option, option_data, xx
+            )
+
         char_ids[name] = xx
 
     return char_ids
 
 
 def write_characterization_header(
-    defaults: Dict[str, Dict[str, str]],
+    defaults: Dict[str, Option],
     char_ids: Dict[str, Dict[str, str]],
     code_output: FileName = "include/toggle.h",
 ):
-    ####################################################################
-    # Code begin
-    code_begin = """\
-#ifndef TOGGLE_H
-#define TOGGLE_H
-
-#ifdef __cplusplus
-extern "C"
-{
-#endif
-
-/** @file toggle.h
- * @brief Toggle definitions.
- *
- * This file validates the macro CHAR_ID and includes the corresponding
- * Toggle header.
- *
- * In the list of CHAR_IDS, always add to the end of the list and
- * increment NUM_CHAR_IDS.
- *
- * Numbering starts with 1 because the compiler would treat an undefined
- * CHAR_ID as 0.
- */
-
-#include <stdbool.h>
-#include <stdint.h>
-
-#ifdef DOXYGEN
-    /** @brief Characterization ID (int).
-     *
-     * Define the device characterization: the options and features enabled.
-     *
-     * The characterization ID should be defined when calling CMake (ex:
-     * `cmake -D CHAR_ID=...`) or when calling the compiler (ex:
-     * `gcc -D CHAR_ID=...`).
-     */
-    #define CHAR_ID CHAR_ID_TEST
-#endif
-
-#ifndef CHAR_ID
-    #define CHAR_ID CHAR_ID_TEST
-    #warning "CHAR_ID is not defined. Using default."
-#endif
-
-"""
-
-    ####################################################################
-    # Code end
-    code_end = """\
-#ifdef __cplusplus
-}
-#endif
-
-#endif /* TOGGLE_H */
-"""
-
     ####################################################################
     # Options documentation and default values
-    code_option_doc = """\
+    code_option_doc = [
+        """\
 /* Options documentation. */
 
 #ifdef DOXYGEN
 
 """
+    ]
     for name, data in defaults.items():
-        code_option_doc += f"""\
-{apply_indent(format_brief_descr_comment(data['BRIEF'], data['DESCRIPTION']), indent=4)}
+        code_option_doc.append(
+            f"""\
+{apply_indent(format_brief_descr_comment(data.BRIEF, data.DESCRIPTION), indent=4)}
 {apply_indent(format_h_declaration(data), indent=4)}
 
 """
-    code_option_doc += apply_indent(testing_reset_toggles_decl, indent=4)
-    code_option_doc += """
+        )
+    code_option_doc.append(testing_reset_toggles_decl_indented)
+    code_option_doc.append(
+        """
 #endif /* DOXYGEN */
 
 """
+    )
 
     ####################################################################
     # Characterization IDs
-    code_char_ids = """\
+    code_char_ids = [
+        """\
 /* List of CHAR_IDs. */
 """
-    num = -1  # Set variable for empty char_ids
-    for num, items in enumerate(char_ids.items()):
-        char_id, data = items
-        code_char_ids += (
-            f"#define {char_id} {num+1} /**< @brief {data['BRIEF']} */\n"
-        )
-    code_char_ids += f"""
-#define NUM_CHAR_IDS {num+1} /**< @brief Number of char IDs. */
+    ]
+    code_char_ids.extend(
+        f"#define {char_id} {num} /**< @brief {data['BRIEF']} */\n"
+        for num, (char_id, data) in enumerate(char_ids.items(), start=1)
+    )
+    code_char_ids.append(
+        f"""
+#define NUM_CHAR_IDS {len(char_ids)} /**< @brief Number of char IDs. */
 
 /* Validate CHAR_ID range. */
 #if (CHAR_ID < 1 || CHAR_ID > NUM_CHAR_IDS)
@@ -269,41 +392,71 @@ extern "C"
 #endif
 
 """
+    )
 
     ####################################################################
     # Characterization inclusions
-    code_char_includes = """\
+    code_char_includes = [
+        """\
 /* Include the characterization. */
 #ifdef DOXYGEN
     /* Nothing to include for Doxygen. */
 """
+    ]
     for char_id in char_ids:
-        code_char_includes += (
+        code_char_includes.append(
             f"#elif (CHAR_ID == {char_id})\n"
             f'    #include "characterizations/{char_id.lower()}.h"\n'
         )
-    code_char_includes += f"#endif\n\n"
+    code_char_includes.append(f"#endif\n\n")
 
     ####################################################################
     # Fit everything together and write
-    code = (
-        code_begin
-        + code_option_doc
-        + code_char_ids
-        + code_char_includes
-        + code_end
+    code = "".join(
+        [
+            toggle_h_begin,
+            *code_option_doc,
+            *code_char_ids,
+            *code_char_includes,
+            toggle_h_end,
+        ]
     )
     code = clean_code(code)
-    create_directory(code_output)
-    with open(code_output, "w") as fp:
-        fp.write(code)
+    write_file(code_output, code)
 
 
 def create_directory(filename: FileName):
-    directory = re.sub(r"/[^/]*$", r"", filename)
-    os.makedirs(directory, exist_ok=True)
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def is_file_content(filename: FileName, data: bytes) -> bool:
+    """Return True if the file exists and contains exactly the data."""
+    try:
+        if os.path.getsize(filename) != len(data):
+            return False
+        with open(filename, "rb") as fp:
+            return fp.read() == data
+    except OSError:
+        return False
+
 
+def write_file(filename: FileName, code: str):
+    """Write the code to the file, creating its directory if needed."""
+    data = code.encode("utf-8")
 
+    # Leave the file untouched if it already has this code, so its
+    # modification time does not trigger a rebuild of everything using it
+    if is_file_content(filename, data):
+        return
+
+    create_directory(filename)
+    with open(filename, "wb") as fp:
+        fp.write(data)
+
+
+@functools.lru_cache(maxsize=format_cache_size)
 def format_brief_descr_comment(
     brief: str, descr: str, mid_comment: bool = False
 ) -> str:
@@ -321,53 +474,49 @@ def format_brief_descr_comment(
 
 def apply_indent(code: str, indent: int) -> str:
     indent = " " * indent
-    return indent + ("\n" + indent).join(code.split("\n"))
+    return indent + code.replace("\n", "\n" + indent)
+
+
+# Indented once for the documentation block of include/toggle.h
+testing_reset_toggles_decl_indented = apply_indent(
+    testing_reset_toggles_decl, indent=4
+)
 
 
 def write_characterization_source(
-    defaults: Dict[str, Dict[str, str]],
+    defaults: Dict[str, Option],
     char_ids: Dict[str, Dict[str, str]],
     code_output: FileName = "src/toggle.c",
 ):
-    ####################################################################
-    # Code begin
-    code_begin = """\
-#include "toggle.h"
-
-"""
-
-    ####################################################################
-    # Code end
-    code_end = ""
-
     ####################################################################
     # Characterization inclusions
-    code_char_includes = """\
+    code_char_includes = [
+        """\
 #ifdef DOXYGEN
     /* Nothing to include for Doxygen. */
 """
+    ]
     for char_id in char_ids:
-        code_char_includes += (
+        code_char_includes.append(
             f"#elif (CHAR_ID == {char_id})\n"
             f'    #include "characterizations/{char_id.lower()}.c"\n'
         )
-    code_char_includes += f"#endif\n"
+    code_char_includes.append(f"#endif\n")
 
     ####################################################################
     # Fit everything together and write
-    code = code_begin + code_char_includes + code_end
+    code = "".join([toggle_c_begin, *code_char_includes])
     code = clean_code(code)
-    create_directory(code_output)
-    with open(code_output, "w") as fp:
-        fp.write(code)
+    write_file(code_output, code)
 
 
 def write_char_id_source(
-    defaults: Dict[str, Dict[str, str]],
+    defaults: Dict[str, Option],
     char_id: Dict[str, Dict[str, str]],
 ):
     file_name = char_id["CHAR_ID"].lower() + ".c"
     code_output = f"src/characterizations/{file_name}"
+    testing = is_testing(char_id)
 
     ####################################################################
     # Code begin
@@ -379,53 +528,57 @@ def write_char_id_source(
 
     ####################################################################
     # Options value
-    code_option = ""
+    code_option = []
     for name, data in defaults.items():
-        code_option += f"""\
-{format_c_definition(data, char_id)}
+        code_option.append(
+            f"""\
+{format_c_definition(data, char_id, testing)}
 """
+        )
 
     ####################################################################
     # Testing functions
 
-    if is_testing(char_id):
-        code_option += """
+    if testing:
+        code_option.append(
+            """
 void testing_reset_toggles(void)
 {
 """
+        )
         for name, data in defaults.items():
-            code_option += f"""\
-{apply_indent(format_c_assignment(data, char_id), indent=4)}
+            code_option.append(
+                f"""\
+{apply_indent(format_c_assignment(data, char_id, testing), indent=4)}
 """
-        code_option += "}\n"
+            )
+        code_option.append("}\n")
 
     ####################################################################
     # Necessary headers
 
-    necessary_headers = ""
-    found_headers = re.findall(
-        r"TOP_C: (.*?)(?:\s*\*\/)?$", code_option, re.MULTILINE
-    )
-    found_headers = list(set(found_headers))
-    necessary_headers += "\n".join(found_headers)
-    necessary_headers += "\n"
+    found_headers = {}  # Ordered set
+    for name, data in defaults.items():
+        for header in format_c_headers(data, testing):
+            header = replace_name_value(header, data, char_id)
+            found_headers[header] = None
+    necessary_headers = "\n".join(found_headers) + "\n"
 
     ####################################################################
     # Fit everything together and write
-    code = code_begin + necessary_headers + code_option + code_end
+    code = "".join([code_begin, necessary_headers, *code_option, code_end])
     code = clean_code(code)
-    create_directory(code_output)
-    with open(code_output, "w") as fp:
-        fp.write(code)
+    write_file(code_output, code)
 
 
 def write_char_id_header(
-    defaults: Dict[str, Dict[str, str]],
+    defaults: Dict[str, Option],
     char_id: Dict[str, Dict[str, str]],
 ):
     file_name = char_id["CHAR_ID"].lower() + ".h"
     header_guard = "CHARACTERIZATIONS_" + char_id["CHAR_ID"].upper() + "_H"
     code_output = f"include/characterizations/{file_name}"
+    testing = is_testing(char_id)
 
     ####################################################################
     # Code begin
@@ -449,29 +602,30 @@ def write_char_id_header(
 
     ####################################################################
     # Options value
-    code_option = ""
+    code_option = []
     for name, data in defaults.items():
-        code_option += f"""\
-{format_brief_descr_comment(data['BRIEF'], data['DESCRIPTION'])}
-{format_h_declaration(data, char_id)}
+        code_option.append(
+            f"""\
+{format_brief_descr_comment(data.BRIEF, data.DESCRIPTION)}
+{format_h_declaration(data, char_id, testing)}
 
 """
+        )
 
     ####################################################################
     # Testing functions
 
-    if is_testing(char_id):
-        code_option += apply_indent(testing_reset_toggles_decl, indent=0)
+    if testing:
+        code_option.append(testing_reset_toggles_decl)
 
     ####################################################################
     # Fit everything together and write
-    code = code_begin + code_option + code_end
+    code = "".join([code_begin, *code_option, code_end])
     code = clean_code(code)
-    create_directory(code_output)
-    with open(code_output, "w") as fp:
-        fp.write(code)
+    write_file(code_output, code)
 
 
+@functools.lru_cache(maxsize=format_cache_size)
 def format_comment(comment: str, *, indent: int = 0) -> str:
     comment = comment.rstrip()
     lines = ["", *comment.split("\n")]
@@ -480,24 +634,64 @@ def format_comment(comment: str, *, indent: int = 0) -> str:
 
 
 def format_h_declaration(
-    defaults: Dict[str, str], char_id: Optional[Dict[str, str]] = None
+    defaults: Option,
+    char_id: Optional[Dict[str, str]] = None,
+    testing: Optional[bool] = None,
 ) -> str:
-    code = defaults["H"]
-    return format_ch_def_decl(code, defaults, char_id, format="decl")
+    code = defaults.H
+    return format_ch_def_decl(
+        code, defaults, char_id, format="decl", testing=testing
+    )
 
 
 def format_c_definition(
-    defaults: Dict[str, str], char_id: Optional[Dict[str, str]] = None
+    defaults: Option,
+    char_id: Optional[Dict[str, str]] = None,
+    testing: Optional[bool] = None,
 ) -> str:
-    code = defaults["C"]
-    return format_ch_def_decl(code, defaults, char_id, format="def")
+    code = defaults.C
+    return format_ch_def_decl(
+        code, defaults, char_id, format="def", testing=testing
+    )
 
 
 def format_c_assignment(
-    defaults: Dict[str, str], char_id: Optional[Dict[str, str]] = None
+    defaults: Option,
+    char_id: Optional[Dict[str, str]] = None,
+    testing: Optional[bool] = None,
 ) -> str:
-    code = defaults["TEST_ASSIGN"]
-    return format_ch_def_decl(code, defaults, char_id, format="assign")
+    code = defaults.TEST_ASSIGN
+    return format_ch_def_decl(
+        code, defaults, char_id, format="assign", testing=testing
+    )
+
+
+@functools.lru_cache(maxsize=format_cache_size)
+def format_c_headers(defaults: Option, testing: bool) -> Tuple[str, ...]:
+    """
+    Return the headers requested with TOP_C comments in the source code.
+
+    The headers are taken from the templates, so @NAME@ and @VALUE@ are
+    not replaced yet.
+    """
+    templates = [
+        format_ch_template(
+            defaults.C, defaults.TYPE, defaults.DECL, testing, "def"
+        )
+    ]
+    if testing:
+        templates.append(
+            format_ch_template(
+                defaults.TEST_ASSIGN,
+                defaults.TYPE,
+                defaults.DECL,
+                testing,
+                "assign",
+            )
+        )
+    return tuple(
+        header for code in templates for header in re_top_c.findall(code)
+    )
 
 
 def is_testing(char_id: Optional[Dict[str, str]] = None) -> bool:
@@ -510,12 +704,12 @@ def is_testing(char_id: Optional[Dict[str, str]] = None) -> bool:
 
 def get_value(
     name: str,
-    defaults: Dict[str, str],
+    defaults: Option,
     char_id: Optional[Dict[str, str]] = None,
 ) -> str:
     # Get value from characterization or defaults
     if char_id is None or name not in char_id or char_id[name] == "":
-        value = defaults["DEFAULT"]
+        value = defaults.DEFAULT
     else:
         value = char_id[name]
     return value
@@ -523,13 +717,13 @@ def get_value(
 
 def error_if_value_option_is_set_on_characterization_file(
     name: str,
-    defaults: Dict[str, str],
+    defaults: Option,
     char_id: Dict[str, str],
 ) -> str:
     # Error if a "VALUE option" is being set on the characterization.
     if char_id is None:
         pass
-    elif defaults["TYPE"].startswith("VALUE") and name in char_id:
+    elif defaults.TYPE.startswith("VALUE") and name in char_id:
         assert name not in char_id, (
             f"{name} is declared with TYPE = VALUE and cannot be "
             "redefined in the characterization. "
@@ -539,21 +733,51 @@ def error_if_value_option_is_set_on_characterization_file(
 
 def format_ch_def_decl(
     code: str,
-    defaults: Dict[str, str],
+    defaults: Option,
     char_id: Dict[str, str],
     *,
     format: str,
+    testing: Optional[bool] = None,
 ):
-    typ = defaults["TYPE"]
-    decl = defaults["DECL"]
-    name = defaults["NAME"]
+    typ = defaults.TYPE
+    decl = defaults.DECL
+    if testing is None:
+        testing = is_testing(char_id)
+
+    code = format_ch_template(code, typ, decl, testing, format)
+
+    # Update values on the code
+    return replace_name_value(code, defaults, char_id)
+
+
+def replace_name_value(
+    code: str,
+    defaults: Option,
+    char_id: Optional[Dict[str, str]] = None,
+) -> str:
+    """Replace @NAME@ and @VALUE@ with the option name and its value."""
+    name = defaults.NAME
     value = get_value(name, defaults, char_id)
-    testing = is_testing(char_id)
-    testing_changes = False
+    code = code.replace("@NAME@", name)
+    code = code.replace("@VALUE@", value)
+    return code
 
-    error_if_value_option_is_set_on_characterization_file(
-        name, defaults, char_id
-    )
+
+@functools.lru_cache(maxsize=format_cache_size)
+def format_ch_template(
+    code: Optional[str],
+    typ: str,
+    decl: str,
+    testing: bool,
+    format: str,
+) -> str:
+    """
+    Return the code template of an option, with @CONST@ already replaced.
+
+    The result depends only on the fields of the option and on testing,
+    not on its value, so it is computed once and shared by all char IDs.
+    """
+    testing_changes = False
 
     # No custom code. Generate default.
 
@@ -584,6 +808,7 @@ def format_ch_def_decl(
             # MACRO (without type) cannot be tested
             base = "MACRO"
             decl = "MACRO"
+            test_assign = ""
         elif decl == "CUSTOM":
             # CUSTOM cannot be tested
             # Nothing to do for custom
@@ -615,44 +840,8 @@ def format_ch_def_decl(
             )
 
         # Changes when testing
-        if base == "MACRO":
-            if testing and testing_changes:
-                # When testing and not a value, a macro is transformed
-                # in a non-const variable
-                if format == "decl":
-                    code = f"extern {decl};"
-                elif format == "def":
-                    code = f"{decl} = @VALUE@;"
-                elif format == "assign":
-                    code = test_assign
-            else:
-                if format == "decl":
-                    code = f"#define @NAME@ @VALUE@"
-                elif format == "def":
-                    code = ""
-                elif format == "assign":
-                    code = ""
-        elif base == "CONST":
-            if format == "decl":
-                code = f"extern @CONST@ {decl};"
-            elif format == "def":
-                code = f"@CONST@ {decl} = @VALUE@;"
-            elif testing and testing_changes:
-                # When testing and not a value, a const is transformed
-                # in a non-const variable
-                if format == "assign":
-                    code = test_assign
-        elif base == "VAR":
-            if format == "decl":
-                code = f"extern {decl};"
-            elif format == "def":
-                code = f"{decl} = @VALUE@;"
-            elif format == "assign":
-                code = test_assign
-
-    # Update values on the code
-    code = code.replace("@NAME@", name)
-    code = code.replace("@VALUE@", value)
+        code = base_code_dict[base, testing and testing_changes, format]
+        code = code.format(decl=decl, test_assign=test_assign)
 
     const = "" if testing and testing_changes else "const"
     if const == "":
@@ -665,32 +854,140 @@ def format_ch_def_decl(
 
 
 def clean_code(code: str) -> str:
+    if clean_code_with_regex:
+        return clean_code_regex(code)
+
+    # One pass over the lines, equivalent to clean_code_regex()
+    lines = []
+    for line in code.strip().split("\n"):
+        # Remove trailing whitespace
+        line = line.rstrip(" \t")
+
+        if line == "":
+            # No multiple new lines and no new line after braces
+            if lines and (lines[-1] == "" or lines[-1].endswith("{")):
+                continue
+        elif line.startswith("}"):
+            # No new line before braces
+            if lines and lines[-1] == "":
+                lines.pop()
+
+        lines.append(line)
+
+    # One LF at the end of the file
+    return "\n".join(lines) + "\n"
+
+
+def clean_code_regex(code: str) -> str:
     # One LF at the end of the file
     code = code.strip() + "\n"
 
     # Remove trailing whitespace
-    code = re.sub(r"[ \t]+$", r"", code, flags=re.MULTILINE)
+    code = re_trailing_whitespace.sub(r"", code)
 
     # One new line before and after braces
-    code = re.sub(r"\n\n+}", r"\n}", code)
-    code = re.sub(r"{\n\n+", r"{\n", code)
+    code = re_blank_before_brace.sub(r"\n}", code)
+    code = re_blank_after_brace.sub(r"{\n", code)
 
     # No multiple new lines
-    code = re.sub(r"\n\n\n+", r"\n\n", code)
+    code = re_multiple_new_lines.sub(r"\n\n", code)
 
     return code
 
 
+def write_char_id_files(
+    defaults: Dict[str, Option],
+    char_id: Dict[str, Dict[str, str]],
+):
+    write_char_id_header(defaults, char_id)
+    write_char_id_source(defaults, char_id)
+
+
+def hash_files(filenames: List[FileName]) -> str:
+    """Return the hex digest of the contents of the files."""
+    h = hashlib.blake2b()
+    for filename in filenames:
+        with open(filename, "rb") as fp:
+            data = fp.read()
+        # Prefix the size so moving bytes between files changes the hash
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def is_up_to_date(digest: str) -> bool:
+    """Return True if the stamp matches and all its output files exist."""
+    try:
+        with open(stamp_file, encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+    except OSError:
+        return False
+    if not lines or lines[0] != digest:
+        return False
+    return all(os.path.isfile(filename) for filename in lines[1:])
+
+
+def count_available_cpus() -> int:
+    """Return the number of CPUs this process is allowed to run on."""
+    # os.cpu_count() counts all CPUs of the host, even when the affinity of
+    # the process (e.g. in a container) restricts it to fewer
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def write_stamp(code: str):
+    """
+    Write the stamp file, even if its content did not change.
+
+    The generated files are left untouched when they do not change, so the
+    build system checks the modification time of the stamp instead.
+    """
+    with open(stamp_file, "wb") as fp:
+        fp.write(code.encode("utf-8"))
+
+
 def main():
+    # The generator itself is an input: changing it changes the output
+    inputs = ["yaml/defaults.yaml", "yaml/char_ids.yaml", __file__]
+    digest = hash_files(inputs)
+    if is_up_to_date(digest):
+        # Nothing to generate, but tell the build system it was checked
+        os.utime(stamp_file)
+        return
+
     defaults = read_defaults("yaml/defaults.yaml")
     char_ids = read_char_ids("yaml/char_ids.yaml", defaults=defaults)
 
     write_characterization_header(defaults, char_ids)
     write_characterization_source(defaults, char_ids)
 
-    for name, char_id in char_ids.items():
-        write_char_id_header(defaults, char_id)
-        write_char_id_source(defaults, char_id)
+    # Char ID files are independent of each other. Generate them in worker
+    # processes when there is enough work to pay for starting them.
+    num_workers = min(
+        count_available_cpus(),
+        len(defaults) * len(char_ids) // parallel_options_per_worker,
+    )
+    if num_workers > 1:
+        chunksize = -(-len(char_ids) // num_workers)
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+            # Consume the results to propagate errors from the workers
+            for _ in executor.map(
+                write_char_id_files,
+                itertools.repeat(defaults),
+                char_ids.values(),
+                chunksize=chunksize,
+            ):
+                pass
+    else:
+        for name, char_id in char_ids.items():
+            write_char_id_files(defaults, char_id)
+
+    outputs = ["include/toggle.h", "src/toggle.c"]
+    for name in char_ids:
+        outputs.append(f"include/characterizations/{name.lower()}.h")
+        outputs.append(f"src/characterizations/{name.lower()}.c")
+    write_stamp("".join(f"{x}\n" for x in [digest] + outputs))
 
 
 if __name__ == "__main__":